@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.core.management import BaseCommand
 
-from lazy_srcset.tests.the_test import output_files_list, output_html
+from lazy_srcset.tests.the_test import output_files_list, output_html, warm_images
 
 
 class Command(BaseCommand):
@@ -13,15 +13,19 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         tests_dir = settings.BASE_DIR / "lazy_srcset" / "tests"
 
+        # Generate the images concurrently first so output_html only has to render
+        warm_images()
+
+        # output_html caches renders against LAZY_SRCSET_ENABLED so toggling it below can't reuse this output
         expected_html_file = tests_dir / "expected_html.html"
-        expected_html_file.write_text(output_html())
+        expected_html_file.write_bytes(output_html().encode("utf-8"))
 
         expected_files_file = tests_dir / "expected_files.txt"
-        expected_files_file.write_text(output_files_list())
+        expected_files_file.write_bytes(output_files_list().encode("utf-8"))
 
         settings.LAZY_SRCSET_ENABLED = False
         expected_html_file_disabled = tests_dir / "expected_html_disabled.html"
-        expected_html_file_disabled.write_text(output_html())
+        expected_html_file_disabled.write_bytes(output_html().encode("utf-8"))
 
         expected_files_file_disabled = tests_dir / "expected_files_disabled.txt"
-        expected_files_file_disabled.write_text("")
+        expected_files_file_disabled.write_bytes(b"")
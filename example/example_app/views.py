@@ -1,10 +1,42 @@
+import os
+
+from django.conf import settings
 from django.http import HttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.cache import cache_page
+
+from lazy_srcset.tests.the_test import output_dir_mtime, output_html
+
+# Cached responses vary on this request header, the_view sets it to the state of the images.
+IMAGES_STATE_HEADER = "X-Images-State"
 
-from lazy_srcset.tests.the_test import output_html
+
+def images_state():
+    """
+    Changes whenever lazy-srcset is toggled or images are added to or removed from MEDIA_ROOT or the output directory.
+    """
+    return "%s:%s:%s" % (
+        settings.LAZY_SRCSET_ENABLED,
+        os.stat(settings.MEDIA_ROOT).st_mtime_ns,
+        output_dir_mtime(),
+    )
+
+
+@cache_page(60 * 60, key_prefix="the_view")
+def render_the_view(request):
+    response = HttpResponse(output_html())
+    patch_vary_headers(response, [IMAGES_STATE_HEADER])
+    if images_state() != request.META["HTTP_X_IMAGES_STATE"]:
+        # Rendering generated images so the state this response would be cached against is already out of date.
+        patch_cache_control(response, private=True)
+    return response
 
 
 def the_view(request):
     """
     We can use this view to check the output of the_test in the browser and confirm things are working as expected.
+
+    The response is cached against the state of the images, so a stale page is never served.
     """
-    return HttpResponse(output_html())
+    request.META["HTTP_X_IMAGES_STATE"] = images_state()
+    return render_the_view(request)
@@ -20,6 +20,28 @@ class LazySrcsetSettings:
     # The default generator to use when not specified in the config.
     LAZY_SRCSET_GENERATOR_ID = "lazy_srcset:srcset_image"
 
+    # When an image needs more than one width generating they are generated in parallel threads.
+    # Set to False if your server doesn't like template tags starting threads.
+    LAZY_SRCSET_PARALLEL = True
+
+    # The maximum number of threads used to generate the widths for one image.
+    LAZY_SRCSET_MAX_WORKERS = 8
+
+    # When True only the widest image is generated during the request, the other widths are generated in background
+    # threads and their urls are predicted from the imagekit file name so the first render is quick.  This assumes the
+    # generator makes images exactly the width asked for, which the default generator does.
+    LAZY_SRCSET_BACKGROUND = False
+
+    # The url, width and height of generated images are remembered so imagekit isn't asked about them on every render.
+    # Images on disk are checked they still exist each time, images in other storages (E.g. S3) are asked about again
+    # after this many seconds. Set to None to remember them for the life of the process.
+    LAZY_SRCSET_REMEMBER_TIMEOUT = 60 * 60
+
+    # The loading and decoding attributes added to every img so browsers can put off loading and decoding images until
+    # they are needed.  Set either to None to leave it out.
+    LAZY_SRCSET_LOADING = "lazy"
+    LAZY_SRCSET_DECODING = "async"
+
     # Configs
     LAZY_SRCSET = {
         "default": {
@@ -38,6 +60,7 @@ class LazySrcsetSettings:
             # This prevents images being created which are too similar in size
             # If threshold is not provided LAZY_SRCSET_THRESHOLD is used
             # Set to 0 to generate all images even if they are only 1 px smaller
+            # Or set a percentage of the previous width E.g. "15%" to space images out evenly
             "threshold": LAZY_SRCSET_THRESHOLD,
             # If generator_id is not provided LAZY_SRCSET_GENERATOR_ID is used
             "generator_id": LAZY_SRCSET_GENERATOR_ID,
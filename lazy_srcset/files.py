@@ -0,0 +1,80 @@
+import threading
+from io import BytesIO
+
+from django.core.files.images import ImageFile, get_image_dimensions
+
+
+class LazyImageFile(ImageFile):
+    """
+    An ImageFile which, like a FieldFile, is only opened when it is needed. ImageFile knows how to open itself from the
+    name and closing it before then does nothing.
+    """
+
+    mode = "rb"
+
+    def close(self):
+        if self.file is not None:
+            super().close()
+
+
+class StaticImageFile(LazyImageFile):
+    """
+    An image for a static file with an url attribute. It is never opened if imagekit already has all the generated
+    images.
+    """
+
+    def __init__(self, path, url):
+        super().__init__(None, name=path)
+        self.url = url
+
+    def _get_image_dimensions(self):
+        # Static files are on disk so the dimensions are read from the path, this file is never opened for them.
+        # Pillow can't read SVGs and would read the whole file finding that out, so it isn't asked.
+        if not hasattr(self, "_dimensions_cache"):
+            if self.name.lower().endswith(".svg"):
+                self._dimensions_cache = None, None
+            else:
+                self._dimensions_cache = get_image_dimensions(self.name)
+        return self._dimensions_cache
+
+
+def source_loader(source):
+    """
+    Returns a function that reads and returns the contents of source. The file is only read once, by whichever thread
+    asks first, and the contents are shared with the others.
+    """
+    lock = threading.Lock()
+    contents = []
+
+    def load():
+        with lock:
+            if not contents:
+                closed = source.closed
+                source.open("rb")
+                try:
+                    source.seek(0)
+                    contents.append(source.read())
+                finally:
+                    if closed:
+                        source.close()
+        return contents[0]
+
+    return load
+
+
+class SourceCopy(LazyImageFile):
+    """
+    A copy of a source image that can be used in another thread. Each copy has its own in memory file, so threads
+    never share a file pointer, but the source is only read once between them (see source_loader).
+    """
+
+    def __init__(self, source, load):
+        super().__init__(None, name=source.name)
+        self.load = load
+
+    def open(self, mode=None):
+        if self.closed:
+            self.file = BytesIO(self.load())
+        else:
+            self.seek(0)
+        return self
@@ -9,7 +9,9 @@ Use at your own risk!
 For these reasons this remains an undocumented and untested feature.
 """
 
+import os
 import re
+from collections import deque
 from pathlib import Path
 
 from django.conf import settings
@@ -17,6 +19,11 @@ from django.core.cache import caches
 from django.core.files.storage import get_storage_class
 from django.core.management import BaseCommand
 
+from lazy_srcset.templatetags.lazy_srcset import clear_caches
+
+# Matches the .hash.ext on the end of files named by the source_name_dot_hash namer
+HASH_RE = re.compile(r"\.[^.]+\.([^.]+$)")
+
 
 class Command(BaseCommand):
     help = (
@@ -27,58 +34,96 @@ class Command(BaseCommand):
     static_storage = None
     root_path = None
     cache = None
+    # Deletions are batched so the cache keys can be deleted with one delete_many call
+    batch_size = 1000
+    pending_keys = None
+    pending_paths = None
 
-    def file_exists(self, path, file):
+    def source_stems(self, path):
         """
-        Check the storage and static storage for the file.
-        The file can have a different extension.
+        Get the stems of all files in path from the storage and static storage.
+        Sources can have a different extension so only the stems are compared.
         """
-        file_stem = Path(file).stem
+        stems = set()
         for storage in [self.storage, self.static_storage]:
             try:
                 directories, files = storage.listdir(path)
             except FileNotFoundError:
                 continue
 
-            for f in files:
-                if Path(f).stem == file_stem:
-                    return True
+            stems.update(os.path.splitext(f)[0] for f in files)
 
-        return False
+        return stems
 
-    def process_file(self, file, path):
+    def process_file(self, file, path, source_stems):
         """
-        Delete images that no longer have a source.
+        Delete images that no longer have a source. Returns True if the file was deleted.
+        The deletion is queued and happens when the batch is flushed.
         """
-        source_path = path.relative_to(self.root_path)
-        source_file = re.sub(r"\.[^\.]+\.([^\.]+$)", ".\1", file)  # noqa
+        source_file = HASH_RE.sub(r".\1", file, count=1)
 
-        if not self.file_exists(source_path, source_file):
+        if os.path.splitext(source_file)[0] not in source_stems:
             filepath = path / file
 
             cache_key = f"{settings.IMAGEKIT_CACHE_PREFIX}{filepath.relative_to(self.root_path.parent)}-state"
-            self.cache.delete(cache_key)
+            self.pending_keys.append(cache_key)
+            self.pending_paths.append(filepath)
 
-            self.storage.delete(filepath)
-            self.stdout.write(f"Deleted: {filepath}")
+            if len(self.pending_paths) >= self.batch_size:
+                self.flush()
+            return True
+
+        return False
 
-    def process_directory(self, path):
+    def flush(self):
         """
-        Recursively walk through directories.
+        Delete the queued cache keys in one go then delete the queued files.
         """
-        directories, files = self.storage.listdir(path)
+        if self.pending_keys:
+            self.cache.delete_many(self.pending_keys)
 
-        for file in files:
-            self.process_file(file, path)
+        for filepath in self.pending_paths:
+            self.storage.delete(filepath)
+            self.stdout.write(f"Deleted: {filepath}")
 
-        for directory in directories:
-            next_path = path / directory
+        self.pending_keys = []
+        self.pending_paths = []
 
-            self.process_directory(next_path)
+    def process_directory(self, root_path):
+        """
+        Walk through the directories post-order using a stack instead of recursion.
+        The number of entries left in each directory is tracked, so empty directories can be deleted without listing
+        them again.
+        """
+        remaining = {}
+        stack = deque([(root_path, False)])
+
+        while stack:
+            path, visited = stack.pop()
+
+            if not visited:
+                directories, files = self.storage.listdir(path)
+
+                # Sources for this directory are listed once rather than once per file
+                source_stems = self.source_stems(path.relative_to(self.root_path))
+                kept = [
+                    file
+                    for file in files
+                    if not self.process_file(file, path, source_stems)
+                ]
+                remaining[path] = len(kept) + len(directories)
+
+                # Come back to this directory once all of its subdirectories are done
+                stack.append((path, True))
+                stack.extend((path / directory, False) for directory in directories)
+                continue
 
             # Delete empty dirs
-            if not any(self.storage.listdir(next_path)):
-                self.storage.delete(next_path)
+            if path != root_path and not remaining.pop(path):
+                # The files must be gone before the directory can be
+                self.flush()
+                self.storage.delete(path)
+                remaining[path.parent] -= 1
 
     def handle(self, *args, **options):
         """
@@ -106,4 +151,10 @@ class Command(BaseCommand):
 
         self.root_path = path / settings.IMAGEKIT_CACHEFILE_DIR
 
+        self.pending_keys = []
+        self.pending_paths = []
         self.process_directory(self.root_path)
+        self.flush()
+
+        # Forget any deleted images this process remembers
+        clear_caches()
@@ -1,64 +1,349 @@
-import math
+import logging
+import os
 import re
-from pathlib import Path
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import copy_context
+from functools import lru_cache, partial
+from hashlib import blake2b
+from itertools import chain, islice, repeat
+from types import MappingProxyType
 from xml.etree import ElementTree
 
 from django import template
 from django.contrib.staticfiles import finders
 from django.contrib.staticfiles.storage import staticfiles_storage
-from django.core.files.images import ImageFile
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured, SuspiciousFileOperation
+from django.core.files.storage import FileSystemStorage
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.template.exceptions import TemplateSyntaxError
-from django.utils.html import format_html
+from django.utils.html import escape, format_html
+from django.utils.safestring import mark_safe
 from imagekit.cachefiles import ImageCacheFile
+from imagekit.exceptions import NotRegistered
 from imagekit.registry import generator_registry
+from imagekit.utils import autodiscover
 
 from lazy_srcset.conf import settings
+from lazy_srcset.files import SourceCopy, StaticImageFile, source_loader
+
+try:
+    from imagekit.cachefiles.state import (
+        prefetch_cachefile_states,
+        use_cachefile_state_cache,
+    )
+except ImportError:  # pragma: no cover
+    # Older versions of imagekit can't prefetch cache file states, each width checks the cache by itself.
+    use_cachefile_state_cache = None
 
 register = template.Library()
 
+logger = logging.getLogger(__name__)
+
+# kwargs which override the config for one use of the srcset tag.
+CONFIG_KWARGS = frozenset(["default_size", "max_width", "quality", "threshold"])
+
+# The units sizes can be given in.
+SIZE_UNITS = frozenset(["px", "vw"])
+
+# Settings which get_base_config depends on.
+CONFIG_SETTINGS = frozenset(
+    ["LAZY_SRCSET", "LAZY_SRCSET_THRESHOLD", "LAZY_SRCSET_GENERATOR_ID"]
+)
+
+# Settings which change where files are or what they are called, the in-process caches are cleared when they change.
+FILE_SETTINGS = ("MEDIA_", "STATIC", "IMAGEKIT_", "STORAGES", "DEFAULT_FILE_STORAGE")
+
+# In-process caches keep at most this many entries each.
+CACHE_MAX_SIZE = 4096
+
+# The url, width and height of generated images keyed by everything imagekit uses to name them, see remembered_variant.
+_variants = {}
+
+# Generates images in the background when LAZY_SRCSET_BACKGROUND = True. Created when first needed.
+_background_executor = None
+_background_lock = threading.RLock()
+
+# Generates images alongside the rendering thread when LAZY_SRCSET_PARALLEL = True. Created when first needed and
+# shared by every render so threads aren't started and stopped for each image.
+_parallel_executor = None
+_parallel_lock = threading.Lock()
+
+# The keys of images being generated in the background, so they are only queued once.
+_background_keys = set()
+
+# The width and height of svg files keyed by name and modified time.
+_svg_dimensions = {}
+
+# The width and height of source images keyed by name and modified time.
+_image_dimensions = {}
+
+# The finished attrs for svg files keyed by name, url and modified time.
+_svg_html = {}
+
+# Held whilst any of the in-process caches above are changed, they are shared with the thread pools.
+_remember_lock = threading.Lock()
+
+
+# The root <svg> element, after any BOM, whitespace, <?xml ...?>, comments or doctype, see read_svg_attrs. A > inside a
+# quoted attribute value doesn't end the tag.
+SVG_ROOT_RE = re.compile(
+    rb"""(?:\xef\xbb\xbf)?(?:\s|<[?!][^>]*>)*<svg\b((?:[^>"']|"[^"]*"|'[^']*')*)>"""
+)
+# The attributes of the root element are only trusted when they are nothing but name="value" pairs with no entities or
+# whitespace to decode in the values, otherwise the parser reads them.
+SVG_ATTRS_RE = re.compile(
+    rb"""(?:\s+[^\s=/>"']+\s*=\s*(?:"[^"&<\t\n\r]*"|'[^'&<\t\n\r]*'))*\s*/?"""
+)
+SVG_ATTR_RE = re.compile(rb"""([^\s=/>"']+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+
+
+class StripUnitsTable(dict):
+    """
+    A str.translate table that deletes everything but digits and dots E.g. units like px or pt from SVG dimensions.
+    Any character it doesn't know about is deleted, not just ASCII ones, so nothing else can slip through. SVGs can
+    come from anywhere so this is a single linear pass with no regex to backtrack.
+    """
+
+    def __missing__(self, key):
+        return None
+
+
+STRIP_UNITS = StripUnitsTable((ord(c), ord(c)) for c in "0123456789.")
+
 
 def lists_to_dict(keys, values, default_value=100):
     """
     Combine uneven lists into a dictionary padding values with default_value if the values list is shorter than the
     keys list.  If the values list is longer it will ignore any extra values.
     """
-    combined_dict = {}
-    for key, value in zip(keys, values):
-        combined_dict[key] = value
-    for key in keys[len(values):]:  # fmt: skip
-        combined_dict[key] = default_value
-    return combined_dict
+    padding = zip(islice(keys, len(values), None), repeat(default_value))
+    return dict(chain(zip(keys, values), padding))
+
+
+def resolve_static(path):
+    """
+    Returns the absolute path and url for a static file. Finders are slow so this is only done once per path, unless
+    DEBUG is on when static files are likely to come and go.
+    """
+    if settings.DEBUG:
+        return find_static(path)
+    return cached_find_static(path)
+
+
+def find_static(path):
+    """
+    Does the work for resolve_static. Once collectstatic has been run the file is in the static files storage, which is
+    one look rather than asking every finder, so that is tried first unless DEBUG is on.
+    """
+    url = staticfiles_storage.url(path)
+    if not settings.DEBUG:
+        try:
+            abs_path = staticfiles_storage.path(path)
+        except (ImproperlyConfigured, NotImplementedError, SuspiciousFileOperation):
+            # No STATIC_ROOT, storage that isn't on disk or a path outside it.
+            abs_path = None
+        if abs_path and os.path.isfile(abs_path):
+            return abs_path, url
+    return finders.find(path), url
+
+
+cached_find_static = lru_cache(maxsize=2048)(find_static)
+
+
+# get_modified_time returns this for files in storages that aren't on disk.
+REMOTE = object()
+
+
+def local_path(file):
+    """
+    Returns the path of file on disk or None if it isn't on disk or its storage can't say. StaticImageFile is named by
+    its path, any other file without a storage E.g. one in memory has no path.
+    """
+    if isinstance(file, StaticImageFile):
+        return file.name
+
+    try:
+        storage = file.storage
+    except AttributeError:
+        return None
+
+    try:
+        return storage.path(file.name)
+    except (NotImplementedError, SuspiciousFileOperation, TypeError, ValueError):
+        return None
+
+
+def get_modified_time(file):
+    """
+    Returns the modified time of file if it is on disk, or None if it can't be found. Asking any other storage could
+    mean a request per image per render E.g. a HEAD request to S3, so REMOTE is returned instead. Like imagekit we then
+    assume a file with the same name is the same file, and anything keyed on REMOTE is only remembered in this process.
+    Files with no path or storage E.g. in memory return None as there is nothing to say they haven't changed.
+    """
+    path = local_path(file)
+    if path is None:
+        return REMOTE if hasattr(file, "storage") else None
+
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def remember(cache, key, value):
+    """
+    Store value in one of our in-process caches, forgetting the oldest entry when it is full. Threads in the pools
+    remember things too so this is done under a lock, otherwise finding the oldest entry can fail with "dictionary
+    changed size during iteration".
+    """
+    with _remember_lock:
+        # Dicts remember insertion order so the first key is the oldest.
+        if len(cache) >= CACHE_MAX_SIZE:
+            cache.pop(next(iter(cache)), None)
+        cache[key] = value
+    return value
+
+
+def forget(cache, key):
+    """
+    Remove key from one of our in-process caches, if it is there.
+    """
+    with _remember_lock:
+        cache.pop(key, None)
+
+
+def clear_caches():
+    """
+    Forget everything remembered in this process about generated and source images E.g. after generated images have
+    been deleted. Called when the settings for files change and by the imagekit_cleanup command.
+    """
+    with _remember_lock:
+        for remembered in (_variants, _image_dimensions, _svg_dimensions, _svg_html):
+            remembered.clear()
+
+
+def get_image_dimensions(source_img):
+    """
+    Returns the width and height of source_img. Getting them means opening the file and reading the header, so they
+    are remembered until the file is modified. On a warm cache that means the source is never opened at all.
+    """
+    modified_time = get_modified_time(source_img)
+    key = (source_img.name, modified_time)
+    if modified_time is not None and key in _image_dimensions:
+        return _image_dimensions[key]
+
+    dimensions = source_img.width, source_img.height
+    if modified_time is None:
+        return dimensions
+    return remember(_image_dimensions, key, dimensions)
+
+
+def strip_units(value):
+    """
+    Returns value with everything but digits and dots removed E.g. "100.5px" -> "100.5" or None if value is None.
+    Usually there aren't any units so plain numbers are returned as they are.
+    """
+    if value is None or (value.isascii() and value.isdigit()):
+        return value
+    return value.translate(STRIP_UNITS)
+
+
+def read_svg_attrs(f):
+    """
+    Returns the attributes of the root element of the open svg file f, or None if the root isn't <svg>. Usually the
+    root element is right at the start with plain attributes so a regex picks it out of the first chunk. Otherwise the
+    chunks are fed to an XMLPullParser until it sees the root. Either way the rest of the file (often lots of path
+    data) is never read.
+    """
+    chunk = f.read(4096)
+    match = SVG_ROOT_RE.match(chunk) if isinstance(chunk, bytes) else None
+    if match and SVG_ATTRS_RE.fullmatch(match.group(1)):
+        return {
+            name.decode(): (double or single).decode(errors="replace")
+            for name, double, single in SVG_ATTR_RE.findall(match.group(1))
+        }
+
+    parser = ElementTree.XMLPullParser(events=("start",))
+    while True:
+        if not chunk:
+            # Raises ParseError as there is no root element.
+            parser.close()
+        parser.feed(chunk)
+        for _, root in parser.read_events():
+            # The root should be <svg> with or without a namespace E.g. {http://www.w3.org/2000/svg}svg
+            if root.tag != "svg" and not root.tag.endswith("}svg"):
+                return None
+            return root.attrib
+        chunk = f.read(4096)
 
 
 def get_svg_dimensions(svg_file):
     """
     Try and get width and height from the svg file or return none for them if not possible.
+    The result is remembered until the file is modified, in this process and in the default cache so other processes
+    don't need to read the file either. SVGs which aren't on disk are only remembered in this process.
     """
-    with svg_file.open() as f:
-        tree = ElementTree.parse(f)
-        root = tree.getroot()
+    modified_time = get_modified_time(svg_file)
+    if modified_time is None:
+        return read_svg_dimensions(svg_file)
+
+    key = (svg_file.name, modified_time)
+    try:
+        return _svg_dimensions[key]
+    except KeyError:
+        pass
 
-        # Get width and height from attributes if they are set.
-        width, height = root.get("width"), root.get("height")
+    if modified_time is REMOTE:
+        return remember(_svg_dimensions, key, read_svg_dimensions(svg_file))
+
+    # Names can contain anything and have any length so they are hashed to make a safe cache key.
+    name_and_time = f"{svg_file.name}:{modified_time}".encode()
+    cache_key = f"lazy_srcset:svg:{blake2b(name_and_time, digest_size=16).hexdigest()}"
+    dimensions = cache.get(cache_key)
+    if dimensions is None:
+        dimensions = read_svg_dimensions(svg_file)
+        cache.set(cache_key, dimensions, None)
+    return remember(_svg_dimensions, key, dimensions)
 
-        # If width or height attributes are missing, get values from viewbox.
-        if width is None or height is None:
-            viewbox = root.get("viewBox")
-            try:
-                _, _, width, height = viewbox.split(" ")
-            except (AttributeError, ValueError):  # pragma: no cover
-                pass
 
-        # These could include units E.g. px or pt so strip them out.
-        width = re.sub(r"[^\d.]", "", width) if width is not None else None
-        height = re.sub(r"[^\d.]", "", height) if height is not None else None
+def read_svg_dimensions(svg_file):
+    """
+    Does the work for get_svg_dimensions.
+    """
+    # Only the start of the file is read so files on disk are opened straight from their path, skipping the storage.
+    path = local_path(svg_file)
+    with open(path, "rb") if path else svg_file.open("rb") as f:
+        attrs = read_svg_attrs(f)
+
+    # The file is closed again now.
+    if attrs is None:
+        return None, None
+
+    # Get width and height from attributes if they are set.
+    width, height = attrs.get("width"), attrs.get("height")
+
+    # If width or height attributes are missing, get values from viewbox.
+    if width is None or height is None:
+        viewbox = attrs.get("viewBox")
+        try:
+            _, _, width, height = viewbox.split(" ")
+        except (AttributeError, ValueError):  # pragma: no cover
+            pass
 
-    return width, height
+    # These could include units E.g. px or pt so strip them out.
+    return strip_units(width), strip_units(height)
 
 
+@lru_cache(maxsize=256)
 def sanitize_breakpoint(breakpoint):
     """
-    Breakpoints must be integers.
+    Breakpoints must be integers. Templates use the same few breakpoints over and over so results are cached, errors
+    aren't.
     """
     try:
         return int(breakpoint)
@@ -68,30 +353,103 @@ def sanitize_breakpoint(breakpoint):
         )
 
 
+@lru_cache(maxsize=256)
 def sanitize_size(size):
     """
-    Sizes need to be either an integer or a string with px or vw units.
+    Sizes need to be either an integer or a string with px or vw units. Cached like sanitize_breakpoint.
     """
-    try:
+    if not isinstance(size, str):
         return int(size), "vw"
-    except ValueError:
-        pass
 
+    # Look for the units rather than trying int() first and catching the error, that way valid sizes never raise.
     size = size.replace(" ", "")
+    units = size[-2:]
     try:
-        size, units = int(size[:-2]), size[-2:]
-    except (IndexError, ValueError):  # pragma: no cover
+        if units in SIZE_UNITS:
+            return int(size[:-2]), units
+        return int(size), "vw"
+    except ValueError:  # pragma: no cover
         raise TemplateSyntaxError(
             "Invalid size: %s\nBreakpoints must be integers.\nSizes must specify vw or px units or be integers."
             % size
         )
 
-    if units not in ["px", "vw"]:
+
+@lru_cache(maxsize=256)
+def sanitize_threshold(threshold):
+    """
+    Thresholds are either a number of px or a string percentage of the previous width E.g. "15%". Returns (threshold,
+    percent) where percent is None for px, otherwise threshold needs working out from it for each width.
+    """
+    if not isinstance(threshold, str) or not threshold.endswith("%"):
+        return threshold, None
+
+    try:
+        return 0, int(threshold[:-1])
+    except ValueError:  # pragma: no cover
         raise TemplateSyntaxError(
-            "Invalid size: %s\nUnits must be px or vw." % size
-        )  # pragma: no cover
+            "Invalid threshold: %s\nThresholds must be integers or percentages E.g. '15%%'."
+            % threshold
+        )
+
+
+@lru_cache(maxsize=256)
+def get_sizes(breakpoint_sizes):
+    """
+    Returns the sanitized breakpoints and sizes sorted narrowest first E.g. ((640, 100, "vw"), (1024, 50, "vw")) and
+    the sizes attr for them without the default size on the end. breakpoint_sizes is a tuple of (breakpoint, size)
+    pairs. Templates use the same few combinations over and over so the sorting and formatting is only done once each.
+    """
+    sizes_dict = {sanitize_breakpoint(k): sanitize_size(v) for k, v in breakpoint_sizes}
+    sizes = tuple(
+        (breakpoint_width, width, units)
+        for breakpoint_width, (width, units) in sorted(sizes_dict.items())
+    )
+    # These are ints and a validated unit so there is nothing to escape. Each entry brings its own separator as the
+    # default size always comes last.
+    sizes_attr = "".join(f"(max-width: {b}px) {w}{u}, " for b, w, u in sizes)
+    return sizes, sizes_attr
+
+
+@lru_cache(maxsize=None)
+def get_base_config(conf_key):
+    """
+    Returns the config for conf_key from settings with the defaults from settings set. This is shared between renders
+    so it is read only, get_config copies it if kwargs override anything.
+    """
+    conf = dict(settings.LAZY_SRCSET[conf_key])
+    conf["breakpoints"] = tuple(conf["breakpoints"])
+    conf.setdefault("threshold", settings.LAZY_SRCSET_THRESHOLD)
+    conf.setdefault("generator_id", settings.LAZY_SRCSET_GENERATOR_ID)
+    return MappingProxyType(conf)
+
+
+@lru_cache(maxsize=None)
+def get_ignored_extensions():
+    """
+    Returns LAZY_SRCSET_IGNORED_EXTENSIONS in lower case, each starting with a dot, as a tuple ready for str.endswith.
+    """
+    return tuple(
+        ext.lower() if ext.startswith(".") else f".{ext.lower()}"
+        for ext in settings.LAZY_SRCSET_IGNORED_EXTENSIONS
+    )
+
+
+@receiver(setting_changed)
+def clear_cached_settings(setting, **kwargs):
+    """
+    Forget the cached base configs, ignored extensions, static files and images when the settings they come from change
+    E.g. with override_settings.
+    """
+    if setting in CONFIG_SETTINGS:
+        get_base_config.cache_clear()
+    elif setting == "LAZY_SRCSET_IGNORED_EXTENSIONS":
+        get_ignored_extensions.cache_clear()
+    elif setting.startswith(("STATIC", "STORAGES")):
+        cached_find_static.cache_clear()
 
-    return size, units
+    if setting.startswith(FILE_SETTINGS):
+        clear_caches()
 
 
 def get_config(kwargs):
@@ -99,35 +457,314 @@ def get_config(kwargs):
     Pop from kwargs as needed and set up the config dict ready for this run.
     After running this kwargs will only contain breakpoints if anything.
     """
-    # Get the conf from the config kwarg or default and copy it so changes don't persist
+    # Get the conf from the config kwarg or default. It is only copied if something needs overriding.
+    conf = get_base_config(kwargs.pop("config", "default"))
+
+    overrides = kwargs.keys() & CONFIG_KWARGS
+    if overrides:
+        conf = dict(conf)
+        for key in overrides:
+            conf[key] = kwargs.pop(key)
+
+    return conf
+
+
+def variant_key(source_img, width, conf):
+    """
+    The key used to remember a generated image, made from everything imagekit uses to name it.
+    """
+    return (
+        conf["generator_id"],
+        source_img.name,
+        width,
+        conf.get("format"),
+        conf["quality"],
+    )
+
+
+def get_generator(conf):
+    """
+    Returns a callable that makes the generator from conf for a source and width. generator_registry.get() runs
+    imagekit's autodiscover and looks up the id every time it is called, so we do that once per srcset instead of once
+    per width, and bind the format and quality which are the same for every width.
+    """
+    return get_generator_factory(
+        conf["generator_id"], conf.get("format"), conf["quality"]
+    )
+
+
+@lru_cache(maxsize=256)
+def get_generator_factory(generator_id, output_format, quality):
+    """
+    Does the work for get_generator. Generators are registered when the apps are loaded so the result is cached for
+    each combination of generator, format and quality. Errors aren't cached.
+    """
+    autodiscover()
     try:
-        conf_key = kwargs.pop("config")
+        generator = generator_registry._generators[generator_id]
     except KeyError:
-        conf_key = "default"
-    conf = settings.LAZY_SRCSET[conf_key].copy()
+        raise NotRegistered("The generator with id %s is not registered" % generator_id)
 
-    # Try to pop these from kwargs
-    for key in ["default_size", "max_width", "quality", "threshold"]:
-        try:
-            conf[key] = kwargs.pop(key)
-        except KeyError:
-            pass
+    if not callable(generator):  # pragma: no cover
+        # Like generator_registry.get() an instance is used as it is.
+        return lambda **kwargs: generator
 
-    # Set a default from settings
-    conf.setdefault("threshold", settings.LAZY_SRCSET_THRESHOLD)
-    conf.setdefault("generator_id", settings.LAZY_SRCSET_GENERATOR_ID)
+    return partial(generator, output_format=output_format, quality=quality)
 
-    return conf
+
+def get_variant(source_img, width, conf, generator=None):
+    """
+    Returns (url, width, height) for source_img generated at width using the generator, format and quality from conf.
+    Results are remembered (see remembered_variant) so repeat renders don't need imagekit to check its cache and open
+    the generated file again. Like imagekit we assume a source with the same name is the same image.
+    generator can be passed in from get_generator() to save looking it up again.
+    """
+    key = variant_key(source_img, width, conf)
+    variant = remembered_variant(key)
+    if variant is not None:
+        return variant
+
+    if generator is None:
+        generator = get_generator(conf)
+    generator_image = ImageCacheFile(generator(width=width, source=source_img))
+    try:
+        open_if_local(generator_image)
+        variant = (generator_image.url, generator_image.width, generator_image.height)
+    finally:
+        generator_image.close()
+
+    path = local_path(generator_image)
+    timeout = settings.LAZY_SRCSET_REMEMBER_TIMEOUT
+    expires = None if path or timeout is None else time.monotonic() + timeout
+    remember(_variants, key, (variant, path, expires))
+    return variant
+
+
+def remembered_variant(key):
+    """
+    Returns the remembered (url, width, height) for key or None if it isn't remembered or might be out of date.
+    Generated images on disk are only used whilst they exist, so emptying the output directory is noticed straight
+    away. Images in other storages are asked about again after LAZY_SRCSET_REMEMBER_TIMEOUT seconds.
+    """
+    try:
+        variant, path, expires = _variants[key]
+    except KeyError:
+        return None
+
+    if path:
+        if os.path.exists(path):
+            return variant
+    elif expires is None or time.monotonic() < expires:
+        return variant
+
+    forget(_variants, key)
+    return None
+
+
+def open_if_local(generator_image):
+    """
+    imagekit asks its cache whether an image exists before using it. When the image is in local storage it is quicker
+    to just look, so if it is on disk it is opened now and imagekit skips the cache. Otherwise imagekit carries on as
+    usual and generates it if needs be.
+    """
+    storage = generator_image.storage
+    if not isinstance(storage, FileSystemStorage):
+        return
+
+    try:
+        generator_image.file = storage.open(generator_image.name, "rb")
+    except FileNotFoundError:
+        pass
+
+
+def get_variants(source_img, widths, conf):
+    """
+    Returns get_variant for each of widths. If LAZY_SRCSET_PARALLEL is set and more than one width isn't known yet
+    they are fetched (and generated if needs be) in a thread pool first. Pillow releases the GIL whilst resizing and
+    encoding so this gives us a real speed up. Each thread gets its own SourceCopy so they don't fight over the file.
+    If LAZY_SRCSET_BACKGROUND is set the widths that aren't known yet, apart from the first (widest), are generated in
+    the background instead and their urls predicted.
+    """
+    variants = [remembered_variant(variant_key(source_img, w, conf)) for w in widths]
+    missing = [w for w, variant in zip(widths, variants) if variant is None]
+    if not missing:
+        # Every width is remembered from an earlier render, the usual case once a site is warmed up.
+        return variants
+
+    generator = get_generator(conf)
+
+    if settings.LAZY_SRCSET_BACKGROUND:
+        # Only generate the widest image now (it is used for src, width and height) and predict the others.
+        background = [w for w in missing if w != widths[0]]
+        generate_in_background(source_img, background, conf, generator)
+        predicted = {w: predict_variant(source_img, w, generator) for w in background}
+        return [
+            predicted.get(width) or get_variant(source_img, width, conf, generator)
+            for width in widths
+        ]
+
+    with prefetched_states(source_img, missing, generator):
+        max_workers = min(settings.LAZY_SRCSET_MAX_WORKERS, len(missing))
+        if settings.LAZY_SRCSET_PARALLEL and max_workers > 1:
+            load = source_loader(source_img)
+
+            def fetch(width):
+                return get_variant(SourceCopy(source_img, load), width, conf, generator)
+
+            # Threads don't inherit context variables so each width runs in a copy of ours to see the prefetched states.
+            executor = get_parallel_executor()
+            futures = [
+                executor.submit(copy_context().run, fetch, width)
+                for width in missing[1:]
+            ]
+
+            # This thread counts as one of the workers, it does the first (widest) width rather than sitting idle.
+            try:
+                fetch(missing[0])
+            finally:
+                # result() so any exceptions raised in the threads are raised here, and the source isn't closed
+                # whilst they are still using it.
+                for future in futures:
+                    future.result()
+        elif len(missing) > 1:
+            # imagekit opens and closes a closed source for every width it generates, so it is opened once here for all
+            # of them instead. srcset() closes it again.
+            source_img.open("rb")
+
+        return [get_variant(source_img, width, conf, generator) for width in widths]
+
+
+def get_parallel_executor():
+    """
+    Returns the thread pool used by get_variants, creating it the first time. The rendering thread is one of the
+    LAZY_SRCSET_MAX_WORKERS so the pool has one less.
+    """
+    global _parallel_executor
+
+    with _parallel_lock:
+        if _parallel_executor is None:
+            _parallel_executor = ThreadPoolExecutor(
+                max_workers=max(settings.LAZY_SRCSET_MAX_WORKERS - 1, 1),
+                thread_name_prefix="lazy_srcset_parallel",
+            )
+        return _parallel_executor
+
+
+@contextmanager
+def prefetched_states(source_img, widths, generator):
+    """
+    imagekit keeps the state of each generated image (exists, generating...) in the cache and checks it before using
+    the image. Whilst in this context the states for widths are fetched from the cache in one get_many rather than one
+    get per width. Does nothing for a single width or if imagekit is too old to prefetch.
+    """
+    if use_cachefile_state_cache is None or len(widths) < 2:
+        yield
+        return
+
+    with use_cachefile_state_cache() as state_cache:
+        files = [ImageCacheFile(generator(width=w, source=source_img)) for w in widths]
+        prefetch_cachefile_states(files, state_cache=state_cache)
+        yield
+
+
+def predict_variant(source_img, width, generator):
+    """
+    Returns (url, width, None) for an image without generating it. imagekit names files from a hash of the source name
+    and generator options so the url can be worked out up front. The width is assumed to be the width asked for.
+    """
+    generator_image = ImageCacheFile(generator(width=width, source=source_img))
+    return generator_image.storage.url(generator_image.name), width, None
+
+
+def background_variant(source_img, width, conf, generator, key):
+    """
+    get_variant for use in a background thread. Errors are logged as there is nobody else to tell.
+    """
+    try:
+        get_variant(source_img, width, conf, generator)
+    except Exception:  # pragma: no cover
+        logger.exception("Failed to generate %s at width %s", source_img.name, width)
+    finally:
+        with _background_lock:
+            _background_keys.discard(key)
+
+
+def generate_in_background(source_img, widths, conf, generator):
+    """
+    Queue widths of source_img to be generated in background threads. The source is read now as it is closed when the
+    template tag is done with it.
+    """
+    if not widths:
+        # Only the widest image was missing, that has already been generated so there is no need to read the source.
+        return
+
+    load = source_loader(source_img)
+    load()
+
+    # The lock is held whilst queueing so wait_for_background can't shut the executor down in the middle.
+    with _background_lock:
+        executor = get_background_executor()
+        for width in widths:
+            key = variant_key(source_img, width, conf)
+            if key in _background_keys:
+                continue
+
+            _background_keys.add(key)
+            executor.submit(
+                background_variant,
+                SourceCopy(source_img, load),
+                width,
+                conf,
+                generator,
+                key,
+            )
+
+
+def get_background_executor():
+    """
+    Returns the thread pool used by generate_in_background, creating it the first time.
+    """
+    global _background_executor
+
+    with _background_lock:
+        if _background_executor is None:
+            _background_executor = ThreadPoolExecutor(
+                max_workers=settings.LAZY_SRCSET_MAX_WORKERS,
+                thread_name_prefix="lazy_srcset",
+            )
+        return _background_executor
+
+
+def wait_for_background():
+    """
+    Wait for the images being generated in the background to be finished E.g. in tests. The threads are stopped and
+    started again next time they are needed.
+    """
+    global _background_executor
+
+    with _background_lock:
+        executor, _background_executor = _background_executor, None
+
+    if executor is not None:
+        executor.shutdown(wait=True)
 
 
 def svg_srcset(source_img):
     """
     Returns attrs string containing src and width and height if possible. Will also add role="img" attr.
+    The attrs only depend on the url and the file so they are remembered until the file is modified. Things like a
+    logo on every page are then only looked at once.
     """
-    # Try getting width and height from attrs.
+    url = source_img.url
+    modified_time = get_modified_time(source_img)
+    key = (source_img.name, url, modified_time)
+    if modified_time is not None and key in _svg_html:
+        return _svg_html[key]
+
+    # Try getting width and height from attrs. For an SVG these are usually None (Pillow can't read it) but finding
+    # that out means opening the file, so they are remembered like any other source image dimensions.
     try:
-        width = source_img.width
-        height = source_img.height
+        width, height = get_image_dimensions(source_img)
     except AttributeError:  # pragma: no cover
         width, height = None, None
 
@@ -138,14 +775,15 @@ def svg_srcset(source_img):
     # Return with width and height if we have them.
     if width is not None and height is not None:
         html = format_html(
-            'src="{}" width="{}" height="{}" role="img"', source_img.url, width, height
+            'src="{}" width="{}" height="{}" role="img"', url, width, height
         )
     else:
         # Return with src only if we don't have width and height
-        html = format_html('src="{}" role="img"', source_img.url)
+        html = format_html('src="{}" role="img"', url)
 
-    source_img.close()
-    return html
+    if modified_time is None:
+        return html
+    return remember(_svg_html, key, html)
 
 
 def noop(source_img):
@@ -153,14 +791,11 @@ def noop(source_img):
     The no-op returns src, width and height so images still work.
     This is used when LAZY_SRCSET_ENABLED=False and whilst images are being generated.
     """
-    html = format_html(
-        'src="{}" width="{}" height="{}"',
-        source_img.url,
-        source_img.width,
-        source_img.height,
+    # The width and height are ints, only the url needs escaping.
+    width, height = get_image_dimensions(source_img)
+    return mark_safe(
+        f'src="{escape(source_img.url)}" width="{width}" height="{height}"'
     )
-    source_img.close()
-    return html
 
 
 @register.simple_tag
@@ -180,10 +815,17 @@ def srcset(*args, **kwargs):
     The config with the key ``default`` is used unless you provide the config kwarg to specify another config to use.
 
     You can use the ``max_width``, ``threshold`` and ``quality`` kwargs to override the config on a per-use basis.
+    The threshold can be a percentage of the previous width instead of px, this spaces images out evenly whatever the
+    breakpoints are.
 
     The default size (for any resolution above the biggest break point) is set to the same as the biggest break point
     by default. If you want to set the default size to something else use the ``default_size`` kwarg.
 
+    The ``loading`` and ``decoding`` attributes are added from the LAZY_SRCSET_LOADING and LAZY_SRCSET_DECODING
+    settings. Use the ``loading`` and ``decoding`` kwargs to override them, set them to None to leave them out. The
+    ``fetchpriority`` kwarg adds the fetchpriority attribute E.g. for the main image at the top of a page. Setting
+    ``priority=True`` is short for ``loading='eager' fetchpriority='high'``.
+
     Example usage (where image is a file-like e.g. ImageField or a string representing a path to a static file):
 
     <!-- All sizes assumed to be 100vw -->
@@ -214,12 +856,24 @@ def srcset(*args, **kwargs):
     <!-- Specify threshold as a kwarg -->
     <img {% srcset image threshold=100 %} />
 
+    <!-- Specify threshold as a percentage of the previous width -->
+    <img {% srcset image threshold='15%' %} />
+
     <!-- Specify default size as a kwarg (otherwise it is assumed to be the same as the biggest breakpoint) -->
     <img {% srcset image default_size=50 %} />
 
     <!-- You can set the default size with units in the same way as the sizes args -->
     <img {% srcset image default_size='300px' %} />
 
+    <!-- Load an image above the fold straight away -->
+    <img {% srcset image loading='eager' %} />
+
+    <!-- Load the most important image on the page first -->
+    <img {% srcset image loading='eager' fetchpriority='high' %} />
+
+    <!-- The same thing -->
+    <img {% srcset image priority=True %} />
+
     <!-- You can mix and match all of the above E.g. -->
     <img {% srcset image 25 33 50 config='custom_breakpoints' max_width=1920 image_quality=50 threshold=100 %} />
     <img {% srcset image 1920=25 1024=50 default_size=50 image_quality=50 %} />
@@ -227,113 +881,143 @@ def srcset(*args, **kwargs):
     args = list(args)
 
     # If the image has an open method we should be good to go.  If not assume it's a string and get it from
-    # staticfiles wrapped up in ImageFile. Set the url attribute, so we can use it later.
+    # staticfiles wrapped up in StaticImageFile which has the url attribute, so we can use it later.
     source_img = args.pop(0)
     if not hasattr(source_img, "open"):
-        url = staticfiles_storage.url(source_img)
-        source_img = ImageFile(open(finders.find(source_img), "rb"))
-        source_img.url = url
+        source_img = StaticImageFile(*resolve_static(source_img))
+
+    # These go on every img whatever happens with the source. A priority image is loaded straight away and first.
+    if kwargs.pop("priority", False):
+        kwargs.setdefault("loading", "eager")
+        kwargs.setdefault("fetchpriority", "high")
+    loading = loading_attrs(
+        kwargs.pop("loading", settings.LAZY_SRCSET_LOADING),
+        kwargs.pop("decoding", settings.LAZY_SRCSET_DECODING),
+        kwargs.pop("fetchpriority", None),
+    )
+
+    # Whatever happens make sure the source is closed again.
+    try:
+        return source_srcset(source_img, args, kwargs) + loading
+    finally:
+        source_img.close()
+
+
+@lru_cache(maxsize=64)
+def loading_attrs(loading, decoding, fetchpriority=None):
+    """
+    Returns the loading, decoding and fetchpriority attrs E.g. ' loading="lazy" decoding="async"', leaving out any
+    which are None or empty. There are only ever a few combinations so they are cached.
+    """
+    html = mark_safe("")
+    if loading:
+        html += format_html(' loading="{}"', loading)
+    if decoding:
+        html += format_html(' decoding="{}"', decoding)
+    if fetchpriority:
+        html += format_html(' fetchpriority="{}"', fetchpriority)
+    return html
+
 
-    file_extension = Path(source_img.name).suffix.lower()
+def source_srcset(source_img, args, kwargs):
+    """
+    Does the work for srcset once source_img is a file. See srcset for the args and kwargs.
+    """
+    # Checking the end of the name is all we need to find the extension.
+    name = source_img.name.lower()
+    is_svg = name.endswith(".svg")
+
+    # If LAZY_SRCSET_ENABLED = False return src, width and height. SVGs carry on as they're handled the same either way.
+    if not settings.LAZY_SRCSET_ENABLED and not is_svg:
+        return noop(source_img)
 
     # Check if the file extension should be ignored
-    if file_extension in [
-        ext.lower() for ext in settings.LAZY_SRCSET_IGNORED_EXTENSIONS
-    ]:
+    if name.endswith(get_ignored_extensions()):
         return noop(source_img)
 
     # If the image is an SVG return now with src, width and height if possible. SVG is lazy king!
-    if file_extension == ".svg":
+    if is_svg:
         return svg_srcset(source_img)
 
-    # If LAZY_SRCSET_ENABLED = False return src, width and height
-    if not settings.LAZY_SRCSET_ENABLED:
-        return noop(source_img)
-
-    # Prepare config, sizes_dict and widths_dict
+    # Prepare config, sizes_dict and candidate widths
     conf = get_config(kwargs)
 
-    # If we have kwargs we can set the sizes otherwise try and get them from args.
+    # If we have kwargs we can set the sizes otherwise try and get them from args. The sizes are strings and might
+    # contain px|vw. After this sizes will be like: ((1280, 50, "vw"), (1920, 50, "vw"))
     sizes_dict = kwargs or lists_to_dict(conf["breakpoints"], args)
-
-    # The sizes in our dict are strings and might contain px|vw. After this our dict will be like: {1920: (50, "vw")}
-    sizes_dict = {
-        sanitize_breakpoint(k): sanitize_size(v) for k, v in sizes_dict.items()
-    }
+    sizes, sizes_attr = get_sizes(tuple(sizes_dict.items()))
 
     # Set the maximum width image in our srcset.
-    if conf["max_width"] is None or conf["max_width"] > source_img.width:
+    max_width = conf["max_width"]
+    threshold, percent = sanitize_threshold(conf["threshold"])
+    source_width, _ = get_image_dimensions(source_img)
+    if max_width is None or max_width > source_width:
         # Limit max_width to image.width or use image.width if max_width is None.
-        conf["max_width"] = source_img.width
+        max_width = source_width
 
-    # widths_dict is a dict with the image width as key and a boolean if the image must be created E.g. {960: True}
-    widths_dict = {conf["max_width"]: True}
+    # candidates is a list of (image width, a boolean if the image must be created) E.g. [(960, True)]. Widths can
+    # appear more than once, they are merged when the list is sorted below.
+    candidates = [(max_width, True)]
 
-    # Loop through the sizes_dict to create the widths_dict used for image generation.  Create sizes list for the attr
-    sizes = []
-    width, units = "100", "vw"
-    for breakpoint_width in sorted(sizes_dict.keys()):
-        width, units = sizes_dict[breakpoint_width]
+    if percent is not None:
+        # Ceiling division like the target widths below.
+        threshold = (max_width * percent + 99) // 100
 
-        # Add an entry to sizes
-        sizes.append(
-            format_html("(max-width: {}px) {}{}", breakpoint_width, width, units)
-        )
+    # Optional widths within threshold of max_width would always be skipped below, so they're left out to begin with.
+    optional_limit = max_width - max(threshold, 1)
 
+    # Loop through the sizes to create the candidates used for image generation.
+    width, units = "100", "vw"
+    for breakpoint_width, width, units in sizes:
         if units == "px":
             # When px units are defined always generate an image with that width
-            widths_dict[width] = True
+            candidates.append((width, True))
             continue
 
-        # Calculate the target width for this breakpoint with some quick maths.
-        target_width = math.ceil(breakpoint_width * width / 100)
-        if target_width < conf["max_width"]:
+        # Calculate the target width for this breakpoint with some quick maths (ceiling division without floats).
+        target_width = (breakpoint_width * width + 99) // 100
+        if target_width <= optional_limit:
             # Don't upscale images, that would require extra effort.
-            widths_dict[target_width] = False
+            candidates.append((target_width, False))
 
     # Add the default size (sneaky use of the sorted loop above leaves us with the width and units we need)
     if "default_size" in conf.keys():
         width, units = sanitize_size(conf["default_size"])
-    sizes.append(format_html("{}{}", width, units))
+    default_size = width, units
+
+    # Loop through the widths of images and work out what needs to be generated. Sorting puts a required width before
+    # an optional one of the same width, so repeats can be skipped.
+    current_width = max_width
+    widths = []
+    for width, required in sorted(candidates, reverse=True):
+        if widths and width == widths[-1]:
+            continue
 
-    # Loop through the widths of images and generate what is needed
-    current_width = conf["max_width"]
-    output_imgs = []
-    for width in reversed(sorted(widths_dict.keys())):
-        if not widths_dict[width] and (current_width - width) < conf["threshold"]:
+        if not required and (current_width - width) < threshold:
             # Only generate required images and images outside our threshold
             continue
 
-        # Generate the image via imagekit.
-        generator = generator_registry.get(
-            conf["generator_id"],
-            width=width,
-            source=source_img,
-            output_format=conf.get("format"),
-            quality=conf["quality"],
-        )
-        generator_image = ImageCacheFile(generator)
-        output_imgs.append(generator_image)
-
+        widths.append(width)
         current_width = width
+        if percent is not None:
+            threshold = (width * percent + 99) // 100
 
-    # Create the srcsets
+    # Generate the images via imagekit (or remember them from last time).
     try:
-        srcsets = [
-            format_html("{} {}w", image.url, image.width) for image in output_imgs
-        ]
+        output_imgs = get_variants(source_img, widths, conf)
     except FileNotFoundError:  # pragma: no cover
         # Images are being generated in another thread right now, but we can rely on source_img to actually exist
         return noop(source_img)
 
-    source_img.close()
-
-    # Stringify!
-    return format_html(
-        'src="{}" srcset="{}" sizes="{}" width="{}" height="{}"',
-        output_imgs[0].url,
-        ", ".join(srcsets),
-        ", ".join(sizes),
-        output_imgs[0].width,
-        output_imgs[0].height,
+    # With only one image srcset and sizes are pointless E.g. an icon smaller than all the breakpoint widths.
+    src, width, height = output_imgs[0]
+    if len(output_imgs) == 1:
+        return mark_safe(f'src="{escape(src)}" width="{width}" height="{height}"')
+
+    # Stringify! Everything is an int or a validated unit apart from the urls, so only they need escaping.
+    srcset_attr = ", ".join(f"{escape(url)} {w}w" for url, w, _ in output_imgs)
+    default_width, default_units = default_size
+    return mark_safe(
+        f'src="{escape(src)}" srcset="{srcset_attr}" sizes="{sizes_attr}{default_width}{default_units}" '
+        f'width="{width}" height="{height}"'
     )
@@ -1,98 +1,311 @@
+import hashlib
 import itertools
 import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
 from pathlib import Path
+from xml.etree import ElementTree
 
 import pytest
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
 from django.core.files.images import ImageFile
+from django.core.files.storage import FileSystemStorage, Storage
 from django.template import Context, Template
 
+from lazy_srcset.files import LazyImageFile, StaticImageFile
+from lazy_srcset.templatetags.lazy_srcset import (
+    clear_caches,
+    read_svg_dimensions,
+    resolve_static,
+    wait_for_background,
+)
+
 
-class DummyImageField(ImageFile):
+class DummyImageField(LazyImageFile):
     """
-    An ImageFile with an url attribute. Should be close enough to what you get when using a models.ImageField
+    An image with an url attribute. Should be close enough to what you get when using a models.ImageField
     """
 
-    @property
-    def filename(self):
-        return Path(self.name).name
+    def __init__(self, path, media_url=None):
+        super().__init__(None, name=str(path))
+        # The url is read for every srcset so work it out once rather than looking up settings each time
+        if media_url is None:
+            media_url = settings.MEDIA_URL
+        self.filename = os.path.basename(self.name)
+        self.url = f"{media_url}{self.filename}"
 
-    @property
-    def url(self):
-        return f"{settings.MEDIA_URL }{self.filename}"
 
-
-def output_html():
+class RemoteStorage(Storage):
     """
-    This will create a template to render using all combinations of the params supplied.
-    Then it will render that template with all images in the example/images directory.
-    We can then compare the output and contents of the images/output directory to some expected output in our test.
-    We can also visit / in our browser to view the result.
-
-    It's going to create a lot of images if they don't exist yet so be a little patient.
+    A storage without paths like S3, which keeps its files in MEDIA_ROOT for the tests.
     """
-    images_dir = settings.MEDIA_ROOT
-    image_suffixes = [".webp", ".png", ".jpg", ".jpeg", ".svg"]
-    images = [
-        DummyImageField(open(i, "rb"))
-        for i in sorted(images_dir.iterdir())
-        if i.is_file() and i.suffix.lower() in image_suffixes
-    ]
 
-    template = "{%% load lazy_srcset %%}{%% for image in images %%}%s{%% endfor %%}"
+    def __init__(self):
+        self.files = FileSystemStorage()
+
+    def _open(self, name, mode="rb"):
+        return self.files.open(name, mode)
+
+    def _save(self, name, content):
+        return self.files.save(name, content)
+
+    def exists(self, name):
+        return self.files.exists(name)
+
+    def delete(self, name):
+        self.files.delete(name)
+
+    def size(self, name):
+        return self.files.size(name)
+
+    def url(self, name):
+        return self.files.url(name)
+
+
+def build_template_tags():
+    """
+    Build the <img> tags for all combinations of the params supplied. This only needs to happen once.
+    """
     template_tag = '<img {%% srcset %s %%} alt="%s" />'
 
-    template_tag_params = [
-        [["image-file", "image"], ["image-static", "image.filename"]],
-        [
+    template_tag_params = (
+        (("image-file", "image"), ("image-static", "image.filename")),
+        (
             None,
-            # ["relative-widths-33-50", "33 50"],
-            # ["fixed-widths-33-50", "'233px' '150px'"],
-            ["mixed-widths", "'233px' '33vw' 50 "],
-        ],
-        [
+            # ("relative-widths-33-50", "33 50"),
+            # ("fixed-widths-33-50", "'233px' '150px'"),
+            ("mixed-widths", "'233px' '33vw' 50 "),
+        ),
+        (
             None,
-            # ["breakpoints-widths-1234=56-789=90", "1234=56 789=90"],
-            # ["breakpoints-widths-fixed-1234=56px-789=90px", "1234='56px' 789='90px'"],
-            [
+            # ("breakpoints-widths-1234=56-789=90", "1234=56 789=90"),
+            # ("breakpoints-widths-fixed-1234=56px-789=90px", "1234='56px' 789='90px'"),
+            (
                 "breakpoints-widths-mixed-1234=56vw-789=90px-123=50",
                 "1234='56vw' 789='90px' 123=50",
-            ],
-        ],
-        [None, ["custom-config-custom", "config='custom'"]],
-        [None, ["quality-50", "quality=50"]],
-        [None, ["max-width-800", "max_width=800"]],
-        [
+            ),
+        ),
+        (None, ("custom-config-custom", "config='custom'")),
+        (None, ("quality-50", "quality=50")),
+        (
+            None,
+            ("max-width-800", "max_width=800"),
+            # Only one image is generated, so there is no srcset or sizes
+            ("max-width-100", "max_width=100"),
+        ),
+        (
             None,
-            ["default_size-50", "default_size=50"],
-            ["default_size-500px", "default_size='500px'"],
-            ["default_size-75vw", "default_size='75vw'"],
-        ],
-        [None, ["threshold-123", "threshold=123"]],
-    ]
-    template_tag_params = itertools.product(*template_tag_params)
+            ("default_size-50", "default_size=50"),
+            ("default_size-500px", "default_size='500px'"),
+            ("default_size-75vw", "default_size='75vw'"),
+        ),
+        (
+            None,
+            ("threshold-123", "threshold=123"),
+            ("threshold-15%", "threshold='15%'"),
+        ),
+    )
+    # The loading attrs don't change the images so they are only combined with the sources rather than everything else
+    loading_params = (
+        ("loading-eager", "loading='eager'"),
+        ("loading-none", "loading=None"),
+        ("decoding-sync", "decoding='sync'"),
+        ("decoding-none", "decoding=None"),
+        ("fetchpriority-high", "fetchpriority='high'"),
+        ("priority", "priority=True"),
+        ("priority-loading-lazy", "priority=True loading='lazy'"),
+    )
+    combos = itertools.chain(
+        itertools.product(*template_tag_params),
+        itertools.product(template_tag_params[0], loading_params),
+    )
 
     template_tags = []
-    for combo in template_tag_params:
-        params = " ".join([p[1] for p in combo if p is not None])
-        alt = " ".join([p[0] for p in combo if p is not None])
-        template_tags.append(template_tag % (params, alt))
+    for combo in combos:
+        params = [p for p in combo if p is not None]
+        template_tags.append(
+            template_tag
+            % (" ".join(p[1] for p in params), " ".join(p[0] for p in params))
+        )
+
+    return "\n".join(template_tags)
+
+
+_TEMPLATE_TAGS_BLOCK = build_template_tags()
+
+_compiled_template = None
+
+
+def get_template():
+    """
+    Compile the template rendered by output_html. Compiling it is expensive and the result never changes so it is only
+    done once.
+    """
+    global _compiled_template
+    if _compiled_template is None:
+        _compiled_template = Template(
+            "{% load lazy_srcset %}{% for image in images %}"
+            + _TEMPLATE_TAGS_BLOCK
+            + "{% endfor %}"
+        )
+    return _compiled_template
+
+
+IMAGE_SUFFIXES = frozenset([".webp", ".png", ".jpg", ".jpeg", ".svg"])
+
+_render_cache = {}
 
-    template = template % "\n".join(template_tags)
 
-    template = Template(template)
+def output_dir_mtime():
+    """
+    The modified time of the output directory, which changes whenever a file is added or removed, or None if imagekit
+    hasn't created it yet E.g. on a fresh checkout.
+    """
+    try:
+        return os.stat(
+            settings.MEDIA_ROOT / settings.IMAGEKIT_CACHEFILE_DIR
+        ).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def render_fingerprint(image_entries):
+    """
+    A cheap fingerprint of everything the output of output_html depends on: whether lazy-srcset is enabled, the
+    source images and the state of the output directory.
+    """
+    parts = [str(settings.LAZY_SRCSET_ENABLED), str(output_dir_mtime())]
+    for e in image_entries:
+        stat = e.stat()
+        parts.append(f"{e.name}:{stat.st_mtime_ns}:{stat.st_size}")
+    return hashlib.blake2b("\n".join(parts).encode()).digest()
+
+
+def list_image_entries():
+    """
+    The DirEntry for each image in MEDIA_ROOT, sorted by name.
+    """
+    media_root = settings.MEDIA_ROOT
+    with os.scandir(media_root) as entries:
+        image_entries = [
+            e
+            for e in entries
+            if e.is_file() and os.path.splitext(e.name)[1].lower() in IMAGE_SUFFIXES
+        ]
+    # scandir order is up to the filesystem, sort on the plain names to keep the output stable
+    image_entries.sort(key=attrgetter("name"))
+    return image_entries
+
+
+def warm_images(max_workers=None):
+    """
+    Render the template once per image in a thread pool so the images imagekit needs are generated concurrently.
+    Each source image is only ever rendered by one thread so no two threads generate the same file. Pillow releases
+    the GIL whilst resizing and encoding so this is quicker than letting output_html generate everything serially.
+    """
+    template = get_template()
+    media_url = settings.MEDIA_URL
+
+    def render(entry):
+        image = DummyImageField(entry.path, media_url)
+        template.render(Context({"images": [image]}))
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        # list() so any exceptions raised in the workers are raised here
+        list(executor.map(render, list_image_entries()))
+
+
+def output_html(use_cache=True):
+    """
+    This will create a template to render using all combinations of the params supplied.
+    Then it will render that template with all images in the example/images directory.
+    We can then compare the output and contents of the images/output directory to some expected output in our test.
+    We can also visit / in our browser to view the result.
+
+    It's going to create a lot of images if they don't exist yet so be a little patient.
+
+    The rendered html is cached against render_fingerprint, use_cache=False will always render the template.
+    """
+    image_entries = list_image_entries()
+
+    if use_cache:
+        try:
+            return _render_cache[render_fingerprint(image_entries)]
+        except KeyError:
+            pass
+
+    media_url = settings.MEDIA_URL
+    images = [DummyImageField(e.path, media_url) for e in image_entries]
+
+    template = get_template()
     context = Context({"images": images})
-    return template.render(context)
+    html = template.render(context)
+
+    # Rendering can generate images so the fingerprint is taken afterwards.
+    _render_cache[render_fingerprint(image_entries)] = html
+    return html
+
+
+_files_cache = None
 
 
 def output_files_list():
+    """
+    List the files in the output directory. The directory mtime changes whenever a file is added or removed so the
+    list is cached against it and only rebuilt when it changes.
+    """
+    global _files_cache
+    output_dir = settings.MEDIA_ROOT / settings.IMAGEKIT_CACHEFILE_DIR
+
+    mtime = output_dir_mtime()
+    if mtime is None:
+        return ""
+    if _files_cache is not None and _files_cache[0] == mtime:
+        return _files_cache[1]
+
+    with os.scandir(output_dir) as entries:
+        files = sorted(
+            e.name
+            for e in entries
+            if e.is_file(follow_symlinks=False) and not e.name.startswith(".")
+        )
+    files = "\n".join(files)
+
+    _files_cache = (mtime, files)
+    return files
+
+
+def empty_output_dir():
+    """
+    Empty the output dir and return the names of anything that isn't a file, which is left behind. It won't exist yet
+    on a fresh checkout so it is created.
+    """
     output_dir = settings.MEDIA_ROOT / settings.IMAGEKIT_CACHEFILE_DIR
-    files = [
-        f.name
-        for f in sorted(output_dir.iterdir())
-        if f.is_file() and not f.name.startswith(".")
-    ]
-    return "\n".join(files)
+    output_dir.mkdir(exist_ok=True)
+    left_behind = []
+    with os.scandir(output_dir) as entries:
+        for e in entries:
+            if e.is_file():
+                os.unlink(e.path)
+            else:
+                left_behind.append(e.name)
+    return left_behind
+
+
+@pytest.fixture(autouse=True)
+def forget_images():
+    """
+    Start each test with nothing remembered about the images, by lazy-srcset in this process or by imagekit in the
+    cache, so each test generates the images it needs rather than relying on the tests before it.
+    """
+    clear_caches()
+    cache.clear()
+    _render_cache.clear()
 
 
 @pytest.mark.parametrize(
@@ -120,15 +333,14 @@ def test_lazy_srcset(settings, enabled, html_file, files_file):
     expected_html = expected_html_file.read_text()
     expected_files = expected_files_file.read_text()
 
-    # Empty the output dir
-    for f in output_dir.glob("*"):
-        if f.is_file():
-            f.unlink()
-
     # Assert the output dir is empty
-    assert not any(output_dir.iterdir())
+    assert not empty_output_dir()
+
+    # Generate the images concurrently first, each image once, so output_html only has to render them
+    if enabled:
+        warm_images()
 
-    # Assert output_html matches the expected html - this will also generate images
+    # Assert output_html matches the expected html
     assert output_html() == expected_html
 
     # Assert the files created matches the expected files
@@ -137,18 +349,167 @@ def test_lazy_srcset(settings, enabled, html_file, files_file):
     # Get the creation timestamp of like one file
     like_one_file = ""
     create_date = None
-    for f in output_dir.iterdir():
-        if f.is_file():
-            like_one_file = str(f)
-            create_date = os.path.getmtime(like_one_file)
-            break
+    with os.scandir(output_dir) as entries:
+        for e in entries:
+            if e.is_file():
+                like_one_file = e.path
+                create_date = e.stat().st_mtime
+                break
 
     if enabled:
-        # Go again
-        output_html()
+        # Go again, skipping the render cache and forgetting the remembered images so imagekit is asked for every
+        # image again
+        clear_caches()
+        output_html(use_cache=False)
 
         # Assert the file wasn't recreated
         assert os.path.getmtime(like_one_file) == create_date
 
         # Assert the list of files hasn't changed
         assert output_files_list() == expected_files
+
+
+@pytest.mark.parametrize(
+    "svg,dimensions",
+    [
+        ["plain.svg", ("10", "20")],
+        ["viewbox.svg", ("300", "150")],
+        ["gt-in-attr.svg", ("10", "20")],
+        ["entity.svg", ("10", "20")],
+        ["newline-viewbox.svg", ("300", "150")],
+        ["doctype.svg", ("10", "20")],
+        ["long-comment.svg", ("10", "20")],
+        ["not-svg.svg", (None, None)],
+    ],
+)
+def test_svg_dimensions(svg, dimensions):
+    """
+    Check the width and height are read from SVGs the same way whether the regex can pick out the root element or the
+    parser has to E.g. entities, a doctype or a root that isn't in the first chunk.
+    """
+    svg_file = StaticImageFile(str(Path(__file__).parent / "svgs" / svg), svg)
+    assert read_svg_dimensions(svg_file) == dimensions
+
+
+def test_svg_without_root():
+    """
+    An SVG without a root element is fed to the parser until the end of the file, which raises a ParseError.
+    """
+    svg_file = StaticImageFile(str(Path(__file__).parent / "svgs" / "no-root.svg"), "")
+    with pytest.raises(ElementTree.ParseError):
+        read_svg_dimensions(svg_file)
+
+
+def test_background(settings):
+    """
+    With LAZY_SRCSET_BACKGROUND only the widest image is generated whilst rendering and the other urls are predicted.
+    Once the background threads are done every url in the srcset should exist.
+    """
+    settings.LAZY_SRCSET_ENABLED = True
+    settings.LAZY_SRCSET_BACKGROUND = True
+    empty_output_dir()
+
+    image = DummyImageField(settings.MEDIA_ROOT / "2560_jpg.jpg")
+    template = Template('{% load lazy_srcset %}<img {% srcset image %} alt="" />')
+    html = template.render(Context({"image": image}))
+    wait_for_background()
+
+    urls = re.findall(r"(\S+) \d+w", re.search(r'srcset="([^"]*)"', html).group(1))
+    assert len(urls) > 1
+    for url in urls:
+        assert (settings.MEDIA_ROOT / url.replace(settings.MEDIA_URL, "", 1)).is_file()
+
+    # Now they are all generated the second render is the same, without predicting anything
+    assert template.render(Context({"image": image})) == html
+
+
+def test_static_root(settings, tmp_path):
+    """
+    With DEBUG off static files are found in STATIC_ROOT, where collectstatic puts them, rather than by asking the
+    finders. Nothing else has seen these files so their dimensions are read by StaticImageFile.
+    """
+    settings.DEBUG = False
+    settings.LAZY_SRCSET_ENABLED = False
+    settings.STATIC_ROOT = str(tmp_path)
+    shutil.copy(settings.MEDIA_ROOT / "2560_jpg.jpg", tmp_path / "collected.jpg")
+    shutil.copy(settings.MEDIA_ROOT / "svg.svg", tmp_path / "collected.svg")
+
+    # The finders don't know about these files, only STATIC_ROOT has them
+    assert resolve_static("collected.jpg") == (
+        str(tmp_path / "collected.jpg"),
+        "/static/collected.jpg",
+    )
+
+    template = Template(
+        "{% load lazy_srcset %}<img {% srcset 'collected.jpg' %} /><img {% srcset 'collected.svg' %} />"
+    )
+    assert template.render(Context()) == (
+        '<img src="/static/collected.jpg" width="2560" height="1440" loading="lazy" decoding="async" />'
+        '<img src="/static/collected.svg" width="100" height="100" role="img" loading="lazy" decoding="async" />'
+    )
+
+
+def test_svg_in_memory():
+    """
+    An SVG which isn't on disk and has no storage E.g. an upload is read from the file itself.
+    """
+    svg = (settings.MEDIA_ROOT / "svg.svg").read_bytes()
+    svg_file = ImageFile(ContentFile(svg), name="uploaded.svg")
+    svg_file.url = "/media/uploaded.svg"
+
+    template = Template("{% load lazy_srcset %}<img {% srcset image %} />")
+    assert template.render(Context({"image": svg_file})) == (
+        '<img src="/media/uploaded.svg" width="100" height="100" role="img" loading="lazy" decoding="async" />'
+    )
+
+
+def test_serial(settings):
+    """
+    With LAZY_SRCSET_PARALLEL off the widths are generated one after another from a source which is opened once, the
+    output is the same as generating them in parallel and the source is closed again afterwards.
+    """
+    settings.LAZY_SRCSET_ENABLED = True
+    template = Template('{% load lazy_srcset %}<img {% srcset image %} alt="" />')
+
+    empty_output_dir()
+    image = DummyImageField(settings.MEDIA_ROOT / "2560_jpg.jpg")
+    parallel_html = template.render(Context({"image": image}))
+
+    settings.LAZY_SRCSET_PARALLEL = False
+    empty_output_dir()
+    clear_caches()
+    cache.clear()
+    image = DummyImageField(settings.MEDIA_ROOT / "2560_jpg.jpg")
+    assert template.render(Context({"image": image})) == parallel_html
+    assert image.closed
+    assert parallel_html.count(" 1920w") == 1
+
+
+def test_remote_variants_expire(settings, monkeypatch):
+    """
+    Generated images in storages that aren't on disk can't be checked cheaply, so they are remembered until
+    LAZY_SRCSET_REMEMBER_TIMEOUT runs out and imagekit is asked about them again.
+    """
+    settings.LAZY_SRCSET_ENABLED = True
+    settings.LAZY_SRCSET_PARALLEL = False
+    settings.LAZY_SRCSET_REMEMBER_TIMEOUT = 60
+    settings.IMAGEKIT_DEFAULT_FILE_STORAGE = "lazy_srcset.tests.the_test.RemoteStorage"
+    template = Template('{% load lazy_srcset %}<img {% srcset image %} alt="" />')
+    image = DummyImageField(settings.MEDIA_ROOT / "2560_jpg.jpg")
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    empty_output_dir()
+    html = template.render(Context({"image": image}))
+    assert "srcset=" in html
+
+    # The generated images are deleted but until the timeout runs out they are remembered
+    empty_output_dir()
+    now += 59
+    assert template.render(Context({"image": image})) == html
+
+    # Then imagekit is asked again, it finds the images are missing so the source is used until they are generated
+    now += 2
+    assert template.render(Context({"image": image})) == (
+        '<img src="/media/2560_jpg.jpg" width="2560" height="1440" loading="lazy" decoding="async" alt="" />'
+    )